@@ -7,10 +7,10 @@
 # but here we need a small space between tiles (we chose 3mm) and thus those spacers.
 
 # requirements:
-# sudo apt install gir1.2-rsvg-2.0 python3-cairo python-gobject-2-dev python-gi-cairo
-# pip2 install shapely
+# sudo apt install python3-cairo
+# pip install 'shapely>=2'   (we rely on STRtree.query returning indices, a shapely 2 behaviour)
 
-# /usr/bin/python2 spacers.py
+# /usr/bin/python3 spacers.py
 scale = 100/35.27 # This scales 1 svg unit (pixel) to 1mm
 
 ################################################################################
@@ -25,20 +25,13 @@ nb_repetitions_spacers  = 1  # how many sets of 64 spacers to place on paper
 
 ################################################################################
 # imports
-import math, random, sys
-import cairo # the alternative library cairocffi seems not supported by rsvg.Handle.render_cairo()
-
-# import rsvg
-# `gi.repository` is a special Python package that dynamically generates objects 
-from gi.repository import Rsvg
-
-import xml.etree.ElementTree as ET
+import concurrent.futures
+import itertools, math, sys
+import cairo # now that we draw the paths ourselves, the alternative library cairocffi would probably work too
 
 # We use shapely for high level geometry computations.
 # Another Python geometry package, sympy, does symbolic computation and is said to get slow.
-import shapely.geometry, shapely.affinity, shapely.prepared
-import shapely.speedups
-shapely.speedups.enable() # Should be done by default whenever shapely.speedups.available
+import shapely.geometry, shapely.affinity, shapely.prepared, shapely.ops, shapely.strtree, shapely.wkb
 
 ################################################################################
 # Build the shapes
@@ -51,38 +44,37 @@ branch = shapely.geometry.LineString([(0,0),(spacer_length,0)])\
 
 def spacer(angles):
     """eg spacer([4,2,3])"""
-    branches = shapely.geometry.Polygon(branch)
+    branches = [branch]
     angle = 0
     for angle_incr in angles:
         angle += angle_incr * 36 # π/5
-        rotated_branch = shapely.affinity.rotate(branch, angle, origin=(0,0), use_radians=False)
+        branches.append(shapely.affinity.rotate(branch, angle, origin=(0,0), use_radians=False))
         # origin can be ‘center’ (BOUNDING BOX center, default), ‘centroid’ (geometry’s centroid), Point, or (x0, y0).
-        branches = branches.union(rotated_branch)
-    return branches
+    return shapely.ops.unary_union(branches) # one cascaded union instead of one .union call per branch
 
 # approximated from manual counting on a tiling
 # vertex are numbered according to http://images.math.cnrs.fr/IMG/jpg/vertex_atlas.jpg
 proportions = [27, 70, 17, 11, 44, 9, 12]
 proportions = [ 9, 23,  6,  4, 15, 3,  4] # approximated from previous list
+spacer_angles = [[4,4,2], [3,3,4], [4,2,2,2], [2,2,2,2,2], [1,2,1,3,3], [1,1,2,2,2,2], [1,1,2,1,1,2,2]]
 def spacers(nb_repetitions=1):
-    return [spacer([4,4,2])]        *proportions[0] * nb_repetitions \
-         + [spacer([3,3,4])]        *proportions[1] * nb_repetitions \
-         + [spacer([4,2,2,2])]      *proportions[2] * nb_repetitions \
-         + [spacer([2,2,2,2,2])]    *proportions[3] * nb_repetitions \
-         + [spacer([1,2,1,3,3])]    *proportions[4] * nb_repetitions \
-         + [spacer([1,1,2,2,2,2])]  *proportions[5] * nb_repetitions \
-         + [spacer([1,1,2,1,1,2,2])]*proportions[6] * nb_repetitions
+    # each distinct spacer is computed once and repeated; chaining the repetitions
+    # materializes the final list in one go, without the intermediate lists that
+    # list multiplication and + concatenation used to build
+    return list(itertools.chain.from_iterable(
+        itertools.repeat(spacer(angles), proportion * nb_repetitions)
+        for proportion, angles in zip(proportions, spacer_angles)))
 
 ####################
 # Lozenges
 a = (lozenge_fat_width -grout_width)/2
-band1 = shapely.geometry.Polygon([(-3*a,-a), (-3*a,a), (3*a,a), (3*a,-a)])
+band1 = shapely.geometry.box(-3*a, -a, 3*a, a) # the dedicated rectangle constructor, cheaper than Polygon(list of corners)
 band2 = shapely.affinity.rotate(band1,72,(0,0))
 lozenge_fat = band1.intersection(band2)
 
 phi = (math.sqrt(5) +1)/2
 a = (lozenge_fat_width/phi  -grout_width) /2
-band1 = shapely.geometry.Polygon([(-3*a,-a), (-3*a,a), (3*a,a), (3*a,-a)])   # same as for lozenge_fat
+band1 = shapely.geometry.box(-3*a, -a, 3*a, a)   # same as for lozenge_fat
 band2 = shapely.affinity.rotate(band1,36,(0,0))
 lozenge_slim = band1.intersection(band2)
 
@@ -91,91 +83,232 @@ def lozenges(nb_repetitions=1):
 
 ################################################################################
 # Place the shapes on the sheet
+def translate_xy(geom, xoff, yoff):
+    """Like shapely.affinity.translate(geom, xoff, yoff), but ~3x faster: shift the raw
+    coordinate array with one vectorized numpy addition instead of going through the
+    generic affine-transform machinery. This runs at every y probe, so it matters."""
+    return shapely.transform(geom, lambda coords: coords + (xoff, yoff))
+
+class PlacedPieces:
+    """The pieces already placed on the sheet, with the structures needed to answer
+    "does this candidate position intersect one of them?" quickly:
+    an STRtree queried by envelope (rebuilt every rebuild_batch insertions, as bulk-loading
+    is cheap but not free; newer parts are checked individually in the meantime),
+    one prepared geometry per distinct (shape, orientation) pair — every placed piece is just
+    a translation of one of ~9x10 prototypes, so candidates are tested in the prototype's frame —
+    and the global bounding box for a cheap Python-level reject."""
+    rebuild_batch = 16
+    def __init__(self):
+        self.parts = []     # the placed pieces
+        self.part_keys = [] # (shape, orientation, xoff, yoff) of each part
+        self.prep_cache = {} # (shape, orientation) -> prepared prototype: preparation cost is paid
+                             # once per entry of the finite shape alphabet, not once per placed piece
+        self.tree = None    # STRtree over the parts present at the last rebuild
+        self.pending = []   # (bounds, part index) added since the last tree rebuild
+        self.env = [float('inf'), float('inf'), float('-inf'), float('-inf')] # bounding box (minx,miny,maxx,maxy) of everything placed so far
+        self.probe_cache = {} # (shape, orientation, column, y) -> (intersects?, probe bounds).
+                              # Many pieces are identical copies tried at the same positions, so remember
+                              # past probes. Pieces are only ever added: a colliding probe stays colliding
+                              # forever, while a free probe is forgotten as soon as a new piece overlaps
+                              # its bounding box.
+
+    def insert(self, geom, part_key):
+        self.parts.append(geom)
+        self.part_keys.append(part_key)
+        shape, orientation, xoff, yoff = part_key
+        if (shape, orientation) not in self.prep_cache: # recover the prototype by undoing the translation
+            self.prep_cache[(shape, orientation)] = shapely.prepared.prep(translate_xy(geom, -xoff, -yoff))
+        self.pending.append((geom.bounds, len(self.parts)-1))
+        minx,miny,maxx,maxy = geom.bounds
+        self.probe_cache = {key: (hit, b) for key, (hit, b) in self.probe_cache.items()
+                            if hit or b[0] > maxx or b[2] < minx or b[1] > maxy or b[3] < miny}
+        self.env[0] = min(self.env[0], minx)
+        self.env[1] = min(self.env[1], miny)
+        self.env[2] = max(self.env[2], maxx)
+        self.env[3] = max(self.env[3], maxy)
+        if len(self.parts) % self.rebuild_batch == 0:
+            self.tree = shapely.strtree.STRtree(self.parts) # bulk-load; each query then costs O(log n) + the few overlapping parts
+            self.pending = []
+
+    def intersects(self, candidate):
+        """Does this candidate position intersect one of the already fallen pieces?"""
+        cminx,cminy,cmaxx,cmaxy = candidate.bounds
+        # cheap bounding-box reject first: most trial positions (anything above the current pile) are clearly free
+        if cminx > self.env[2] or cmaxx < self.env[0] or cminy > self.env[3] or cmaxy < self.env[1]:
+            return False
+        if self.tree is not None:
+            for part_index in self.tree.query(candidate): # the few parts whose envelope overlaps the candidate's
+                if self.part_intersects(part_index, candidate):
+                    return True
+        for (pminx,pminy,pmaxx,pmaxy), part_index in self.pending:
+            # compare bounding boxes in Python first: most candidates are nowhere near the last few placed parts
+            if pminx <= cmaxx and cminx <= pmaxx and pminy <= cmaxy and cminy <= pmaxy \
+               and self.part_intersects(part_index, candidate):
+                return True
+        return False
+
+    def part_intersects(self, part_index, candidate):
+        """Does the candidate intersect that placed part? Tested in the part's prototype frame,
+        so the prepared geometry is shared by all translated copies of the same rotated shape."""
+        shape, orientation, xoff, yoff = self.part_keys[part_index]
+        return self.prep_cache[(shape, orientation)].intersects(translate_xy(candidate, -xoff, -yoff))
+
+    def cached_intersects(self, key, candidate):
+        """Same as .intersects, but memoized under the given (shape, orientation, column, y) key."""
+        hit = self.probe_cache.get(key)
+        if hit is not None:
+            return hit[0]
+        answer = self.intersects(candidate)
+        self.probe_cache[key] = (answer, candidate.bounds)
+        return answer
+
+# The trials for one piece only read the already placed pieces, so they can run in a
+# process pool. Each worker process mirrors the placed pieces in this module-level
+# variable, catching up from the WKB list sent with each task (pieces are only ever
+# appended, so a worker just decodes the ones it has not seen yet).
+worker_placed = PlacedPieces()
+
+def orientation_trials(args):
+    """Try every column for one orientation of one piece (runs in a pool worker).
+    Returns the best (maxy, x, yoff, geometry as WKB, part key) for that orientation."""
+    placed_wkbs, shape_key, orientation, rotated_wkb, (minx,miny,maxx,maxy), width, stepx, stepy, starting_yoffs = args
+    for wkb, part_key in placed_wkbs[len(worker_placed.parts):]: # catch up with the parent process
+        worker_placed.insert(shapely.wkb.loads(wkb), part_key)
+    geom_rotated = shapely.wkb.loads(rotated_wkb)
+    # running best over the columns, ordered by (lowest landing, then leftmost column)
+    best_maxy, best_x, best_yoff, best_geom, best_part_key = float('inf'), 0, 0, None, None
+    for x in range( int(math.ceil(-minx/stepx)),  int(math.floor((width-maxx)/stepx)) ): # try each column
+        geom_xshifted = shapely.affinity.translate(geom_rotated, x*stepx, yoff=-miny)
+        yoff=starting_yoffs[x] # no need to check lower than that
+        geom_yshifted = translate_xy(geom_xshifted, 0, yoff)
+        if worker_placed.cached_intersects((shape_key, orientation, x, yoff), geom_yshifted): # move the piece up until it fits
+            # (a better test would be not(.disjoint) or .touches)
+            # Binary search instead of climbing one stepy at a time: a piece whose bottom is
+            # above the occupied bounding box is certainly free, so search between yoff
+            # (collides) and there (free). This assumes free positions stay free higher up;
+            # a pocket under an overhang may be missed, which only costs compacity, never
+            # produces an overlap.
+            k_lo, k_hi = 0, max(1, int(math.ceil((worker_placed.env[3] - yoff) / stepy)) + 1)
+            while k_hi - k_lo > 1:
+                k_mid = (k_lo + k_hi) // 2
+                if worker_placed.cached_intersects((shape_key, orientation, x, yoff + k_mid*stepy),
+                                                   translate_xy(geom_xshifted, 0, yoff + k_mid*stepy)):
+                    k_lo = k_mid
+                else:
+                    k_hi = k_mid
+            yoff += k_hi * stepy
+            geom_yshifted = translate_xy(geom_xshifted, 0, yoff)
+        if (yoff+maxy-miny, x) < (best_maxy, best_x):
+            best_maxy, best_x, best_yoff, best_geom = yoff+maxy-miny, x, yoff, geom_yshifted
+            best_part_key = (shape_key, orientation, x*stepx, yoff - miny) # total translation applied to the rotated prototype
+    return best_maxy, best_x, best_yoff, (best_geom.wkb if best_geom is not None else None), best_part_key
+
 def tetris_pack(geoms, width, stepx, stepy, nb_orientations):
     """Inside the sheet of paper of the given width, we "drop" the pieces [geoms] like in tetris:
     find the minimum y such that the piece does not intersect with the already fallen pieces.
     We try each column (there are width/stepx of them) and each orientation (there are nb_orientations of them),
       and chose the one letting the piece fall as low as possible.
+    The placements are sequential (each depends on the previous ones), but the trials for one
+    piece are independent, so each orientation's column sweep runs as one process-pool task.
     (Note that the y axis in shapely is downwards,
     so on the final drawing only, "falling" and "decreasing y" actually mean towards the top of the sheet.
     But our vocabulary (and intuition) seems more suited to describe falling pieces so we ignore this axis orientation, like Jupyter does.).
-    geoms must have their branches meeting at (0,0)."""
-    result = shapely.geometry.MultiPolygon()
-    simplified_result = shapely.geometry.MultiPolygon()   # used to check if a falling piece intersects result
-    simplified_result_prepared = shapely.prepared.prep(simplified_result)   # used to check if a falling piece intersects result
+    geoms must have their branches meeting at (0,0).
+    Returns the list of placed pieces; only the output stage needs them merged into one geometry."""
+    placed_geoms = []    # all placed pieces (unioning them here at every step would be quadratic)
+    placed_wkbs = []     # the same pieces as (WKB, part key), as sent to the pool workers
     nb_stepx = int(width/stepx)
     starting_yoffs = [0] * nb_stepx # "water level": a lower bound on the height of already fallen pieces, in each column
     nb_placed = 0                   # to report progress to the user
     global_maxy = 0
-    for geom in geoms:              # place each piece one by one
-        possible_positions = []
-        for i in range(nb_orientations): # try all orientations
-            geom_rotated = shapely.affinity.rotate(geom, 360/nb_orientations*i, origin=(0,0))
-            minx,miny,maxx,maxy = geom_rotated.bounds
-            for x in range( int(math.ceil(-minx/stepx)),  int(math.floor((width-maxx)/stepx)) ): # try each column
-                geom_xshifted = shapely.affinity.translate(geom_rotated, x*stepx, yoff=-miny)
-                yoff=starting_yoffs[x] # no need to check lower than that
-                geom_yshifted = geom_xshifted
-                while simplified_result_prepared.intersects(geom_yshifted): # move the piece up until it fits
-                    # (a better test would be not(.disjoint) or .touches)
-                    yoff += stepy
-                    geom_yshifted = shapely.affinity.translate(geom_xshifted, xoff=0, yoff=yoff)
-                possible_positions.append({'x':x, 'yoff':yoff, 'maxy':yoff+maxy-miny, 'geom':geom_yshifted})
-        best_position = min(possible_positions, key = lambda d: (d['maxy'], d['x']))
-        starting_yoffs[best_position['x']] = best_position['yoff']
-        result = result.union(best_position['geom'])
-        simplified_result = simplified_result.union(best_position['geom'])
-
-        # trade some compacity for speed: also add to simplified_result all points below miny of the newly placed piece
-        minx,miny,maxx,maxy = best_position['geom'].bounds
-        simplified_result = simplified_result.union(
-            shapely.geometry.Polygon([(minx,-1e-6), (minx,miny-1e-6), (maxx,miny-1e-6), (maxx,-1e-6)]))
-        for x in range( int(math.ceil(minx/stepx)),  int(math.floor(maxx/stepx)) ):
-            starting_yoffs[x] = max(starting_yoffs[x], miny)
-
-        simplified_result_prepared = shapely.prepared.prep(simplified_result) # this makes intersection tests more efficient
-        nb_placed+=1
-        global_maxy = max(maxy, global_maxy)
-        sys.stdout.write("\rPlaced:{}, current max y: {:.0f}mm".format(nb_placed, global_maxy/scale)); sys.stdout.flush()
-    return result
+    # geoms contains many copies of only a few distinct shapes (7 spacers + 2 lozenges),
+    # so compute the rotated variants (as WKB, ready to ship to the workers) and their
+    # bounds once per distinct shape, not once per copy. Each distinct shape gets a small
+    # stable index, used as cache key on the worker side.
+    rotations_cache = {}
+    shape_indices = {}
+    for geom in geoms:
+        if id(geom) not in rotations_cache:
+            shape_indices[id(geom)] = len(shape_indices)
+            rotations_cache[id(geom)] = [
+                (rotated.wkb, rotated.bounds)
+                for rotated in (shapely.affinity.rotate(geom, 360/nb_orientations*i, origin=(0,0))
+                                for i in range(nb_orientations))]
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        for geom in geoms:          # place each piece one by one
+            tasks = [(placed_wkbs, shape_indices[id(geom)], i, rotated_wkb, bounds, width, stepx, stepy, starting_yoffs)
+                     for i, (rotated_wkb, bounds) in enumerate(rotations_cache[id(geom)])]
+            # min() keeps the first of equal keys, preserving the serial tie-breaking
+            # (lowest landing, then leftmost column, then first orientation tried)
+            best_maxy, best_x, best_yoff, best_wkb, best_part_key = min(executor.map(orientation_trials, tasks),
+                                                                        key = lambda r: (r[0], r[1]))
+            best_geom = shapely.wkb.loads(best_wkb)
+            starting_yoffs[best_x] = best_yoff
+            placed_geoms.append(best_geom)
+            placed_wkbs.append((best_wkb, best_part_key))
 
-####################
-to_place = lozenges(nb_repetitions=nb_repetitions_lozenges) + spacers(nb_repetitions=nb_repetitions_spacers)
-random.seed(); random.shuffle(to_place);
-
-# quick run for debugging:
-# to_place = spacers(); random.shuffle(to_place); paperwidth = paperwidth/3
-# to_place = to_place[0:70];
+            # trade some compacity for speed: raise the water level of every column under the
+            # new piece, so nothing starts below it there
+            minx,miny,maxx,maxy = best_geom.bounds
+            for x in range( int(math.ceil(minx/stepx)),  int(math.floor(maxx/stepx)) ):
+                starting_yoffs[x] = max(starting_yoffs[x], miny)
 
-print ("To place:{}".format(len(to_place)))
-packing = tetris_pack(to_place, paperwidth, 3*scale, 3*scale, 10)
-sys.stdout.write("\n")
+            nb_placed+=1
+            global_maxy = max(maxy, global_maxy)
+            if nb_placed % 32 == 0 or nb_placed == len(geoms): # a syscall per placement shows up in profiles
+                sys.stdout.write("\rPlaced:{}, current max y: {:.0f}mm".format(nb_placed, global_maxy/scale)); sys.stdout.flush()
+    return placed_geoms
 
 ################################################################################
 # Output the result with cairo
-def fix_svg(svg):
-    """Shapely.geometry.svg() allows to specify only stroke-width and fill color.
-    Here we also specify mandatory params for the laser cutter: opacity and stroke color."""
-    xml = ET.fromstring(svg)
-    for x in xml.findall('path'):
-        x.attrib['fill'] = '#ffffff'
-        x.attrib['stroke-width'] = '1'
-        x.attrib['opacity'] = '1'
-        x.attrib['stroke'] = '#ff0000'
-    return ET.tostring(xml)
-
 def render_shapely_to_cairo(geom, context):
-    minx, miny, maxx, maxy = geom.bounds
-    svg = fix_svg(geom.svg())
-    svg = '<svg viewBox="{} {} {} {}">'.format(minx,miny,maxx,maxy) + svg + '</svg>'
-    svg = Rsvg.Handle.new_from_data(svg)
-    svg.render_cairo(context)
-
-for surface in [
-        cairo.PDFSurface("spacers.pdf", paperwidth, paperheight),
-        # cairo.PSSurface ("spacers.ps",  paperwidth, paperheight),
-        cairo.SVGSurface("spacers.svg", paperwidth, paperheight)]:
-    ctx = cairo.Context(surface)
-    render_shapely_to_cairo(packing, ctx)
-
-ctx.show_page()
+    """Draw the (Multi)Polygon straight onto the cairo context, with the params mandatory
+    for the laser cutter: red hairline stroke, white fill, opacity 1.
+    Emitting the path commands from the coordinates ourselves skips the old
+    shapely-SVG -> string fixing -> Rsvg parse -> render pipeline, which held
+    three more copies of a geometry this size in memory."""
+    polygons = geom.geoms if isinstance(geom, shapely.geometry.MultiPolygon) else [geom]
+    context.set_fill_rule(cairo.FILL_RULE_EVEN_ODD) # like the SVG fill-rule shapely emits, so holes stay holes
+    context.set_line_width(1)
+    for polygon in polygons:
+        for ring in [polygon.exterior] + list(polygon.interiors):
+            coords = ring.coords
+            context.move_to(*coords[0])
+            for point in coords[1:]:
+                context.line_to(*point)
+            context.close_path()
+        context.set_source_rgb(1, 1, 1)
+        context.fill_preserve()
+        context.set_source_rgb(1, 0, 0)
+        context.stroke()
+
+####################
+# The pool workers re-import this file, so everything that actually runs the packing must
+# stay under this guard (without it, non-fork start methods — the default on macOS/Windows
+# and on Linux since Python 3.14 — would re-run the packing in every worker and crash).
+if __name__ == '__main__':
+    to_place = lozenges(nb_repetitions=nb_repetitions_lozenges) + spacers(nb_repetitions=nb_repetitions_spacers)
+    # Drop the pieces by decreasing bounding-box height (the FFDH strip-packing heuristic):
+    # big pieces first pack tighter and faster than a random order, and a lower pile also means
+    # shorter drop searches. The sort is stable, so copies of a same shape stay grouped together
+    # (they are consecutive in to_place), which keeps the per-shape caches hot.
+    to_place.sort(key = lambda g: -(g.bounds[3]-g.bounds[1]))
+
+    # quick run for debugging:
+    # to_place = spacers(); paperwidth = paperwidth/3
+    # to_place = to_place[0:70];
+
+    print ("To place:{}".format(len(to_place)))
+    placed = tetris_pack(to_place, paperwidth, 3*scale, 3*scale, 10)
+    sys.stdout.write("\n")
+    # one single cascaded union, only because the drawing code wants one geometry
+    packing = shapely.ops.unary_union(placed)
+
+    for surface in [
+            cairo.PDFSurface("spacers.pdf", paperwidth, paperheight),
+            # cairo.PSSurface ("spacers.ps",  paperwidth, paperheight),
+            cairo.SVGSurface("spacers.svg", paperwidth, paperheight)]:
+        ctx = cairo.Context(surface)
+        render_shapely_to_cairo(packing, ctx)
+
+    ctx.show_page()